@@ -1,56 +1,118 @@
-### for cron job
 import os
-abspath = os.path.abspath(__file__)
-dname = os.path.dirname(abspath)
-os.chdir(dname)
-###
-
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import aiofiles
+import orjson
+import asyncio
 import configparser
 import datetime
 import time
+import random
+import functools
+import logging
+import argparse
+
+log = logging.getLogger(__name__)
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.ini")
+CHUNK_SIZE = 262144 #bytes written per chunk when streaming downloads to disk
+API_TIMEOUT = (10, 300) #seconds to connect / to wait for a response
+STREAM_TIMEOUT = (10, 60) #seconds to connect / to wait for the next chunk of a streamed download
+RETRIES = 3 #retries of a LeanIX request on connection errors and the status codes below
+RETRY_BACKOFF = 0.5 #seconds, doubled for every further retry
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_config(path, mtime):
+    """
+    Reads the settings from the config file. The modification time is only used as cache key,
+    so the file is parsed again only if it has changed
+    :param path: Path of the config file as String
+    :param mtime: Modification time of the config file in nanoseconds
+    :return: Dictionary with the settings from the MANDATORY and OPTIONAL section
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return {
+        'HOSTNAME': config['MANDATORY']['HOSTNAME'],
+        'APITOKEN': config['MANDATORY']['APITOKEN'],
+        'WORKSPACEID': config['MANDATORY']['WORKSPACEID'],
+        'PROXY_REQUIRED': config.getboolean('MANDATORY', 'PROXY_REQUIRED'),
+        'HTTP_PROXY': config['MANDATORY']['HTTP_PROXY'],
+        'HTTPS_PROXY': config['MANDATORY']['HTTPS_PROXY'],
+        'EXPORT_FILENAME': config['OPTIONAL']['EXPORT_FILENAME'],
+        'SURVEY_FILENAME': config['OPTIONAL']['SURVEY_FILENAME'],
+    }
+
+
+def _json(response):
+    """
+    Parses the JSON body of a response with orjson, which is considerably faster than response.json()
+    :param response: Response of a request to the LeanIX API
+    :return: Parsed JSON body
+    """
+    return orjson.loads(response.content)
 
 
 class LeanIX:
 
     def __init__(self):
-        self.config = configparser.ConfigParser()
-        self.config.read("config.ini")
-        self.instance = self.config['MANDATORY']['HOSTNAME']
+        self.config = _load_config(CONFIG_FILE, os.stat(CONFIG_FILE).st_mtime_ns)
+        self.instance = self.config['HOSTNAME']
         self.base_path = "/services/pathfinder/v1"
         self.poll_url = "/services/poll/v2"
-        self.apitoken = self.config['MANDATORY']['APITOKEN']
+        self.apitoken = self.config['APITOKEN']
         self.header = None
+        self.token_expires_at = 0
+        self._today_date = None
         self.timeout = 7200
 
         #proxy
-        http_proxy = self.config['MANDATORY']['HTTP_PROXY']
-        https_proxy = self.config['MANDATORY']['HTTPS_PROXY']
-        proxy_required = self.config['MANDATORY']['PROXY_REQUIRED']
-        self.proxies = {'http': http_proxy, 'https': https_proxy} if proxy_required is True else None
+        http_proxy = self.config['HTTP_PROXY']
+        https_proxy = self.config['HTTPS_PROXY']
+        proxy_required = self.config['PROXY_REQUIRED']
+        self.proxies = {'http': http_proxy, 'https': https_proxy} if proxy_required else None
+
+        #reuse connections across all requests
+        self.session = requests.Session()
+        retries = Retry(total=RETRIES, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUS, raise_on_status=False)
+        self.session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retries))
 
     def connect(self):
         """
         Establish connection to LeanIX API using provided API token
         to receive access token which can be used for further requests
         """
-        auth_url = self.instance + "/services/mtm/v1/oauth2/token"
+        auth_url = f"{self.instance}/services/mtm/v1/oauth2/token"
         # get the bearer token - see https://dev.leanix.net/v4.0/docs/authentication
-        response = requests.post(auth_url, auth=('apitoken', self.apitoken),
-                                 data={'grant_type': 'client_credentials'}, proxies=self.proxies)
+        response = self.session.post(auth_url, auth=('apitoken', self.apitoken),
+                                     data={'grant_type': 'client_credentials'}, proxies=self.proxies, timeout=API_TIMEOUT)
         response.raise_for_status()
-        self.header = {'Authorization': 'Bearer ' + response.json()['access_token']}
+        token = _json(response)
+        self.header = {'Authorization': 'Bearer ' + token['access_token']}
+        # refresh one minute before the token expires
+        self.token_expires_at = time.monotonic() + token.get('expires_in', 3600) - 60
+
+    def _ensure_token(self):
+        """
+        Requests a new access token only if the current one is missing or about to expire
+        """
+        if self.header is None or time.monotonic() >= self.token_expires_at:
+            self.connect()
 
     def get_today_date(self):
         """
         Creates a String representation of today's date based in the format YYYY-MM-DD
         :return: Today's date as String in format YYYY-MM-DD
         """
-        today = str(datetime.date.today().year) + "-" + f"{datetime.date.today():%m}" + "-" + f"{datetime.date.today():%d}"  # format date to yyyy-mm-dd
-        return today
+        if self._today_date is None:
+            self._today_date = datetime.date.today().isoformat()  # format date to yyyy-mm-dd, determined once per run
+        return self._today_date
 
-    def access_leanix_api(self, url, method="GET", data=None, params=None, stream=False):
+    def access_leanix_api(self, url, method="GET", data=None, params=None, stream=False, extra_headers=None):
         """
         Generic function to send requests to LeanIX API
         :param url: Request URL as String to access
@@ -58,15 +120,12 @@ class LeanIX:
         :param data: JSON data (default None)
         :param params: URL parameter as dictionary (default None)
         :param stream: True if response should be received as stream, otherwise False (default)
+        :param extra_headers: Headers as dictionary sent in addition to the authorization header (default None)
         :return: response
         """
-        response = None
-        if method == "GET":
-            response = requests.get(url, headers=self.header, proxies=self.proxies, params=params, data=data, stream=stream)
-        elif method == "POST":
-            response = requests.post(url, headers=self.header, proxies=self.proxies, params=params, data=data, stream=stream)
-        elif method == "PUT":
-            response = requests.put(url, headers=self.header, proxies=self.proxies, params=params, data=data, stream=stream)
+        headers = {**self.header, **extra_headers} if extra_headers else self.header
+        timeout = STREAM_TIMEOUT if stream else API_TIMEOUT
+        response = self.session.request(method, url, headers=headers, proxies=self.proxies, params=params, data=data, stream=stream, timeout=timeout)
         response.raise_for_status()
         return response
 
@@ -75,98 +134,227 @@ class LeanIX:
         Creates a snapshot of current LeanIX data. Data are stored in Excel file.
         Please use the config file (config.ini) for configuring the directory where results are stored.
         """
-        print("Creating snapshot...")
+        log.info("Creating snapshot...")
 
         #trigger export
-        trigger_export_url = self.instance + self.base_path + "/exports/fullExport"
-        trigger_export_response = self.access_leanix_api(trigger_export_url, method="POST", params={'exportType': 'SNAPSHOT'}).json()
+        base = f"{self.instance}{self.base_path}"
+        trigger_export_url = f"{base}/exports/fullExport"
+        trigger_export_response = _json(self.access_leanix_api(trigger_export_url, method="POST", params={'exportType': 'SNAPSHOT'}))
         job_id = trigger_export_response['data']['jobId']
-        print("Job ID: ", job_id)
-        print("Waiting for snapshot to complete, this may take some time...")
+        log.info("Job ID: %s", job_id)
+        log.info("Waiting for snapshot to complete, this may take some time...")
 
         #check job status and wait for download key
-        status_check_url = self.instance + self.base_path + "/jobs/" + job_id + "/status"
+        status_check_url = f"{base}/jobs/{job_id}/status"
         status = None
         waiting_since = 0
         workspace_id = None
+        processed = None
+        etag = None
+        delay = 2 #seconds, grows while the export makes no progress
 
         while status != "DONE" and waiting_since < self.timeout:
-            self.connect() #refreshing the access token in case that the export takes longer than the validity of the token
-            job_status_response = self.access_leanix_api(status_check_url).json()
-            status = job_status_response["data"]["status"]
-            workspace_id = job_status_response["data"]["workspaceId"]
-            print("Status: ", status, "Progress:", job_status_response["data"]["processed"],'/',job_status_response["data"]["total"])
-            waiting_since += 5
-            time.sleep(5)
+            self._ensure_token() #refreshing the access token in case that the export takes longer than the validity of the token
+            try:
+                #only transfer the status if it has changed since the last poll
+                job_status_response = self.access_leanix_api(status_check_url, extra_headers={'If-None-Match': etag} if etag else None)
+            except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as err:
+                log.warning("Error while checking snapshot status: %s", err)
+                delay = min(60, delay * 2)
+            else:
+                if job_status_response.status_code == 304: #not modified since the last poll
+                    delay = min(60, delay * 1.5)
+                else:
+                    etag = job_status_response.headers.get('ETag')
+                    job_status = _json(job_status_response)["data"]
+                    status = job_status["status"]
+                    workspace_id = job_status["workspaceId"]
+                    log.info("Status: %s Progress: %s / %s", status, job_status["processed"], job_status["total"])
+                    if job_status["processed"] != processed:
+                        delay = 2 #progress made, check again soon
+                    else:
+                        delay = min(60, delay * 1.5)
+                    processed = job_status["processed"]
+            if status != "DONE":
+                waiting_since += delay
+                time.sleep(delay + random.uniform(0, 1))
         
-        if waiting_since >= self.timeout:
-            print("Timeout exceeded. Snapshot not completed.")
+        if status != "DONE":
+            log.error("Timeout exceeded. Snapshot not completed.")
             return False
 
         # request download key
-        request_key_url = self.instance + self.base_path + "/exports"
+        request_key_url = f"{base}/exports"
         key_params = {'exportType':"SNAPSHOT", 'pageSize': 1, 'sorting': 'createdAt', 'sortDirection': "DESC"}
 
-        data = self.access_leanix_api(request_key_url, params=key_params, data=json.dumps({'exportType': 'SNAPSHOT'})).json()
+        data = _json(self.access_leanix_api(request_key_url, params=key_params))
         status = data["data"][0]["status"]
         download_key = data["data"][0]["downloadKey"]
 
         if status != 'COMPLETED':
-            print("Snapshot not completed. Status: ", status)
+            log.error("Snapshot not completed. Status: %s", status)
             return False
         
         #request and store data
-        print("Snapshot completed. Downloading...")
-        download_url = self.instance + self.base_path + "/exports/downloads/" + workspace_id
+        log.info("Snapshot completed. Downloading...")
+        download_url = f"{base}/exports/downloads/{workspace_id}"
 
-        self.header["Accept"] = "application/octet-stream"
         try:
-            binary = self.access_leanix_api(download_url, params={'key': download_key}, stream=True)
+            binary = self.access_leanix_api(download_url, params={'key': download_key}, stream=True,
+                                            extra_headers={'Accept': 'application/octet-stream'})
             #write to file
-            filename = self.config['OPTIONAL']['EXPORT_FILENAME'].replace("{cdate}", self.get_today_date())
-            print("Writing snapshot to ",filename)
+            filename = self.config['EXPORT_FILENAME'].replace("{cdate}", self.get_today_date())
+            log.info("Writing snapshot to %s", filename)
             if binary.status_code == 200:
-                with open(filename, 'wb') as file:
-                    for x in binary.iter_content(1024):
-                        file.write(x)
-            print("Saved to file ", filename)
+                #write to a temporary file first, so an aborted download never leaves a corrupt snapshot behind
+                tmp_filename = filename + ".part"
+                try:
+                    with open(tmp_filename, 'wb', buffering=1 << 20) as file:
+                        for x in binary.iter_content(CHUNK_SIZE):
+                            file.write(x)
+                        file.flush()
+                        os.fsync(file.fileno())
+                    os.replace(tmp_filename, filename)
+                except BaseException:
+                    #remove the partial download, snapshots can be several GB
+                    if os.path.exists(tmp_filename):
+                        os.remove(tmp_filename)
+                    raise
+            log.info("Saved to file %s", filename)
         except requests.exceptions.HTTPError as err:
-            print(f'Error while downloading snapshot: {err}')
+            log.error("Error while downloading snapshot: %s", err)
             return
-        del self.header["Accept"]
 
     def download_surveys(self):
         """
         Downloads the questions and results for each survey run. Data are stored in an Excel file.
         Please use the config file (config.ini) for configuring the directory where results are stored.
         """
+        asyncio.run(self._download_surveys_async())
+
+    def run(self):
+        """
+        Creates the snapshot and downloads the surveys. Both are independent of each other,
+        so the surveys are downloaded while waiting for the snapshot export to complete.
+        """
+        asyncio.run(self._run_async())
+
+    async def _run_async(self):
+        """
+        Runs take_snapshot in a worker thread alongside the survey downloads, see run.
+        A failure of one job does not cancel the other, it is raised once both have finished.
+        """
+        snapshot_result, surveys_result = await asyncio.gather(asyncio.to_thread(self.take_snapshot), self._download_surveys_async(),
+                                                               return_exceptions=True)
+        if isinstance(snapshot_result, BaseException):
+            if isinstance(surveys_result, BaseException):
+                log.error("Error while downloading surveys: %s", surveys_result)
+            raise snapshot_result
+        if isinstance(surveys_result, BaseException):
+            raise surveys_result
+
+    async def _download_surveys_async(self):
+        """
+        Downloads all survey run results concurrently, see download_surveys
+        """
         #get all survey ids
-        print("Downloading surveys...")
-        request_url = self.instance + self.poll_url + "/polls"
-        params = {'workspaceId': self.config['MANDATORY']['WORKSPACEID']}
+        log.info("Downloading surveys...")
+        poll_base = f"{self.instance}{self.poll_url}"
+        request_url = f"{poll_base}/polls"
+        params = {'workspaceId': self.config['WORKSPACEID']}
+        semaphore = asyncio.Semaphore(5) #limit parallel downloads to avoid 429 Too Many Requests
+        stream_timeout = httpx.Timeout(STREAM_TIMEOUT[1], connect=STREAM_TIMEOUT[0])
+
+        async def wait_before_retry(attempt):
+            if attempt:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+        async def fetch_json(client, url):
+            for attempt in range(RETRIES + 1):
+                await wait_before_retry(attempt)
+                response = await client.get(url, headers=self.header, params=params)
+                if response.status_code not in RETRY_STATUS:
+                    break
+            response.raise_for_status()
+            return _json(response)["data"]
+
+        async def fetch_result(client, survey, run):
+            async with semaphore:
+                log.info("Survey %s - Run %s", survey, run)
+                result_url = f"{poll_base}/pollRuns/{run}/poll_results.xlsx"
+                filename = self.config['SURVEY_FILENAME'].replace("{cdate}", self.get_today_date()).replace("{id}", survey).replace("{run}", run)
+                #write to a temporary file first, so a failed download never leaves a truncated result behind
+                tmp_filename = filename + ".part"
+                try:
+                    for attempt in range(RETRIES + 1):
+                        await wait_before_retry(attempt)
+                        async with client.stream("GET", result_url, headers=self.header, params=params, timeout=stream_timeout) as response:
+                            if response.status_code in RETRY_STATUS and attempt < RETRIES:
+                                continue
+                            response.raise_for_status()
+                            async with aiofiles.open(tmp_filename, 'wb') as survey_run_result:
+                                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                                    await survey_run_result.write(chunk)
+                        break
+                    os.replace(tmp_filename, filename)
+                except BaseException:
+                    #remove the partial download, otherwise a .part file is left behind for every failed run
+                    if os.path.exists(tmp_filename):
+                        os.remove(tmp_filename)
+                    raise
+
+        async def fetch_runs(client, survey):
+            run_url = f"{poll_base}/polls/{survey}/pollRuns"
+            runs = await fetch_json(client, run_url)
+
+            #get all run results, a failed run only skips itself
+            results = await asyncio.gather(*(fetch_result(client, survey, run['id']) for run in runs), return_exceptions=True)
+            for run, result in zip(runs, results):
+                if isinstance(result, Exception):
+                    log.error("Error while downloading survey %s - run %s: %s", survey, run['id'], result)
+
+        #HTTP/2 multiplexes all requests to the LeanIX host over a single connection,
+        #connection errors are retried by the transport, retryable status codes above
+        timeout = httpx.Timeout(API_TIMEOUT[1], connect=API_TIMEOUT[0])
+        limits = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        proxy = self.proxies['https'] if self.proxies else None
+        transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, proxy=proxy, retries=RETRIES)
         try:
-            survey_ids = self.access_leanix_api(request_url, params=params).json()["data"]
-    
-            #get all survey runs
-            for survey in [x["id"] for x in survey_ids]:
-                run_url = self.instance + self.poll_url + "/polls/" + survey + "/pollRuns"
-                runs = self.access_leanix_api(run_url, params=params).json()["data"]
-
-                #get all run results
-                for run in [y['id'] for y in runs]:
-                    print("Survey " + survey + " - Run " + run)
-                    result_url = self.instance + self.poll_url + "/pollRuns/" + run + "/poll_results.xlsx"
-                    file = self.access_leanix_api(result_url, params=params)
-                    filename = self.config['OPTIONAL']['SURVEY_FILENAME'].replace("{cdate}", self.get_today_date()).replace("{id}", survey).replace("{run}", run)
-                    with open(filename,'wb') as survey_run_result:
-                        survey_run_result.write(file.content)
-        except requests.exceptions.HTTPError as err:
-            print(f'Error while downloading surveys: {err}')
+            async with httpx.AsyncClient(transport=transport, timeout=timeout) as client:
+                survey_ids = await fetch_json(client, request_url)
+
+                #get all survey runs, a failed survey only skips itself
+                results = await asyncio.gather(*(fetch_runs(client, survey['id']) for survey in survey_ids), return_exceptions=True)
+                for survey, result in zip(survey_ids, results):
+                    if isinstance(result, Exception):
+                        log.error("Error while downloading survey %s: %s", survey['id'], result)
+        except httpx.HTTPError as err:
+            log.error("Error while downloading surveys: %s", err)
             return
 
 
 ########################################
-leanIX = LeanIX()
-leanIX.connect()
-leanIX.take_snapshot()
-leanIX.download_surveys()
+if __name__ == "__main__":
+    ### for cron job
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    ###
+    log_level = os.environ.get("LEANIX_LOG", "INFO").upper()
+    level = logging.getLevelName(log_level) #returns the numeric level for known names only
+    logging.basicConfig(level=level if isinstance(level, int) else logging.INFO, format="%(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING) #no log line per request (incl. workspace id) at INFO
+    if not isinstance(level, int):
+        log.warning("Unknown log level %s in LEANIX_LOG, using INFO", log_level)
+
+    parser = argparse.ArgumentParser(description="Downloads a snapshot and the survey results of a LeanIX workspace")
+    parser.add_argument("--snapshot", action="store_true", help="create and download the snapshot")
+    parser.add_argument("--surveys", action="store_true", help="download the survey results")
+    args = parser.parse_args()
+
+    leanIX = LeanIX()
+    leanIX.connect()
+    if args.snapshot == args.surveys: #both or none selected
+        leanIX.run()
+    elif args.snapshot:
+        leanIX.take_snapshot()
+    else:
+        leanIX.download_surveys()